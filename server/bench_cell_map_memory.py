@@ -0,0 +1,96 @@
+"""/cell_map のピークメモリと応答時間の計測（1セルに観測が数百〜千件ある場合）。
+
+使い方: python bench_cell_map_memory.py [dense|line ...]
+ケースごとに子プロセスで模擬データ（RSSI ノイズ σ=2 dB）を投入して /cell_map?debug=1 を
+1回呼び、プロセスのピーク RSS と /cell_map の所要時間を表示する。
+  - dense: 基地局から 1 km 以内に密集（近傍ペアが多く、メモリが効く）
+  - line:  30 km の直線上に散在、bandwidth_m=20（交点は多いが近傍は少なく、時間が効く）
+ピーク RSS が LIMIT_MB を、所要時間がケースごとの上限を超えた場合は終了コード 1 を返す。
+"""
+import math
+import os
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+LIMIT_MB = 1024
+
+# ケース名: (観測数のリスト, bandwidth_m, /cell_map 所要時間の上限[s])
+CASES = {
+    'dense': ((100, 300, 400), 150.0, 60.0),
+    'line': ((600, 1000), 20.0, 5.0),
+}
+
+
+def _observations(kind, n_obs, m_per_deg_lat, m_per_deg_lon):
+    """(lat, lon, rssi) の模擬観測を返す。基地局は (35.0, 135.0)。"""
+    rnd = random.Random(0)
+    lat0, lon0 = 35.0, 135.0
+    rows = []
+    for i in range(n_obs):
+        if kind == 'dense':
+            r = rnd.uniform(20.0, 1000.0)
+            theta = rnd.uniform(0.0, 2.0 * math.pi)
+            x, y = r * math.cos(theta), r * math.sin(theta)
+        else:
+            x, y = rnd.uniform(-15_000.0, 15_000.0), 200.0
+        r = max(math.hypot(x, y), 1.0)
+        rssi = -40.0 - 10.0 * 2.0 * math.log10(r) + rnd.gauss(0.0, 2.0)
+        rows.append((1_700_000_000_000 + i, lat0 + y / m_per_deg_lat, lon0 + x / m_per_deg_lon,
+                     "LTE", round(rssi), "bench"))
+    return rows
+
+
+def _run_one(kind, n_obs):
+    bandwidth_m, time_limit = CASES[kind][1:]
+    cwd = os.getcwd()
+    # DATABASE は相対パスなので、一時ディレクトリで server を import する（終了時に削除）
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+            import server
+
+            m_per_deg_lon = server.M_PER_DEG * math.cos(math.radians(35.0))
+            conn = sqlite3.connect(server.DATABASE)
+            with conn:
+                conn.executemany("INSERT INTO logs VALUES (?, ?, ?, ?, ?, ?)",
+                                 _observations(kind, n_obs, server.M_PER_DEG, m_per_deg_lon))
+            conn.close()
+
+            client = server.app.test_client()
+            t0 = time.perf_counter()
+            resp = client.get(f'/cell_map?debug=1&bandwidth_m={bandwidth_m}')
+            elapsed = time.perf_counter() - t0
+            assert resp.status_code == 200
+        finally:
+            os.chdir(cwd)
+
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Linux: KB
+    ok = peak_mb <= LIMIT_MB and elapsed <= time_limit
+    print(f"{kind} n={n_obs}: peak RSS {peak_mb:.0f} MB, /cell_map {elapsed:.2f} s"
+          + ("" if ok else f"  (limit {LIMIT_MB} MB / {time_limit:.0f} s)"))
+    return ok
+
+
+def main(argv):
+    if len(argv) == 3 and argv[0] == '--child':
+        return 0 if _run_one(argv[1], int(argv[2])) else 1
+
+    failed = False
+    for kind in argv or CASES:
+        for n_obs in CASES[kind][0]:
+            # ru_maxrss はプロセス単位の最大値なので、ケースごとに別プロセスで計測する
+            rc = subprocess.call([sys.executable, os.path.abspath(__file__), '--child', kind, str(n_obs)])
+            failed |= rc != 0
+    if failed:
+        print("limit exceeded")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,38 +1,87 @@
-from flask import Flask, request, jsonify, g
+from flask import Flask, Response, request, g
+from flask_compress import Compress
+import os
 import sqlite3
+import threading
 import time
 import math
+from functools import lru_cache
+
+import numpy as np
+import orjson
+from scipy.spatial import cKDTree
 
 app = Flask(__name__)
+# 大きな JSON 応答（/map_data, /heatmap_data, /cell_map）を圧縮して返す
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_MIN_SIZE'] = 1024
+# static/ 配下（/map のページ）のブラウザキャッシュ有効期間[s]
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 300
+Compress(app)
 
 DATABASE = "cells.db"
 
+# スレッドごとの読み取り用接続と、/log 専用の書き込み接続
+_local = threading.local()
+_write_lock = threading.Lock()
+_write_db = None
+
+def _connect():
+    """Open a connection with the per-connection PRAGMAs applied."""
+    conn = sqlite3.connect(DATABASE, check_same_thread=False)
+    # 接続単位のPRAGMA（journal_mode=WAL は init_db でDBファイルに永続化済み）
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")  # 64 MB のページキャッシュ
+    conn.execute("PRAGMA mmap_size=268435456")  # 256 MB までメモリマップで読む
+    return conn
+
 def get_db():
-    """Get a database connection for the current request context."""
-    if 'db' not in g:
-        g.db = sqlite3.connect(DATABASE)
-    return g.db
-
-@app.teardown_appcontext
-def close_db(exception):
-    """Close database connection at the end of request."""
-    db = g.pop('db', None)
-    if db is not None:
-        db.close()
+    """Get the read connection for the current thread, reused across requests."""
+    db = getattr(_local, 'db', None)
+    if db is None:
+        db = _local.db = _connect()
+    return db
+
+def get_write_db():
+    """Get the single write connection. Callers must hold _write_lock."""
+    global _write_db
+    if _write_db is None:
+        _write_db = _connect()
+        # トランザクションは BEGIN IMMEDIATE で明示的に開始する（自動 BEGIN を無効化）
+        _write_db.isolation_level = None
+    return _write_db
 
 def init_db():
     """Initialize the database schema."""
     conn = sqlite3.connect(DATABASE)
+    # WAL: /log の書き込み中も読み取り系エンドポイントがブロックされない
+    conn.execute("PRAGMA journal_mode=WAL")
     c = conn.cursor()
     c.execute("DROP TABLE IF EXISTS logs")
     c.execute('''CREATE TABLE logs
                  (timestamp INTEGER, lat REAL, lon REAL, type TEXT, rssi INTEGER, cell_id TEXT)''')
+    # 期間フィルタ (timestamp > ?) と cell_id 指定の範囲検索用インデックス
+    c.execute("CREATE INDEX IF NOT EXISTS idx_logs_ts ON logs(timestamp)")
+    # cell_id が NULL の行（未識別セル）は cell_id 指定の検索に現れないため索引に含めない
+    c.execute("CREATE INDEX IF NOT EXISTS idx_logs_cell_ts ON logs(cell_id, timestamp) WHERE cell_id IS NOT NULL")
     conn.commit()
     conn.close()
 
 # Initialize database on startup
 init_db()
 
+
+def _json_bytes_response(body):
+    """orjson でシリアライズ済みの bytes をそのまま JSON 応答として返す。"""
+    return Response(body, mimetype='application/json')
+
+
+def _json(obj):
+    """jsonify の代替。orjson で直接 bytes にシリアライズする（NumPy 配列もそのまま可）。"""
+    return _json_bytes_response(orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY))
+
 @app.route('/log', methods=['POST'])
 def log():
     data = request.get_json()
@@ -48,22 +97,36 @@ def log():
     lat = data.get("lat")
     lon = data.get("lon")
     cells = data.get("cells", [])
-    db = get_db()
-    c = db.cursor()
-    for cell in cells:
-        c.execute("INSERT INTO logs VALUES (?, ?, ?, ?, ?, ?)",
-                  (timestamp, lat, lon,
-                   cell.get("type"),
-                   cell.get("rssi"),
-                   # None はそのまま渡し、DB では NULL になる
-                   cell.get("cell_id")))
-    db.commit()
-    return jsonify({"status": "ok"})
+    rows = [(timestamp, lat, lon,
+             cell.get("type"),
+             cell.get("rssi"),
+             # None はそのまま渡し、DB では NULL になる
+             cell.get("cell_id"))
+            for cell in cells]
+    with _write_lock:
+        db = get_write_db()
+        # 書き込みロックを先に確保し、途中での昇格（SQLITE_BUSY）を避ける
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany("INSERT INTO logs VALUES (?, ?, ?, ?, ?, ?)", rows)
+            db.execute("COMMIT")
+        except Exception:
+            # COMMIT の失敗も含め、共有の書き込み接続にトランザクションを残さない
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            raise
+    return _json({"status": "ok"})
+
+
+# /map_data の列順（SELECT 句と一致させる）
+MAP_DATA_COLS = ["timestamp", "lat", "lon", "type", "rssi", "cell_id"]
 
 
 @app.route('/map_data')
 def map_data():
-    """通常の観測ログを返す（地図表示用）"""
+    """通常の観測ログを返す（地図表示用）
+    形式: {"cols": MAP_DATA_COLS, "rows": [[timestamp, lat, lon, type, rssi, cell_id], ...]}
+    """
     db = get_db()
     c = db.cursor()
     cell_id_filter = request.args.get('cell_id', None)
@@ -77,18 +140,8 @@ def map_data():
         params.append(cell_id_filter)
     
     c.execute(query, tuple(params))
-    rows = c.fetchall()
-    result = []
-    for r in rows:
-        result.append({
-            "timestamp": r[0],
-            "lat": r[1],
-            "lon": r[2],
-            "type": r[3],
-            "rssi": r[4],
-            "cell_id": r[5]
-        })
-    return jsonify(result)
+    # 行ごとの dict は作らず、列名と行（タプル）の配列で返す
+    return _json({"cols": MAP_DATA_COLS, "rows": c.fetchall()})
 
 
 @app.route('/heatmap_data')
@@ -99,99 +152,157 @@ def heatmap_data():
     cell_id_filter = request.args.get('cell_id', None)
     one_hour_ago_ms = int(time.time() * 1000) - 3600 * 1000
     
+    # lat, lon が NULL の行は除外し、RSSI 未取得は -100 とみなす
     params = [one_hour_ago_ms]
-    query = "SELECT timestamp, lat, lon, type, rssi, cell_id FROM logs WHERE timestamp > ?"
+    query = ("SELECT lat, lon, COALESCE(rssi, -100) FROM logs"
+             " WHERE timestamp > ? AND lat IS NOT NULL AND lon IS NOT NULL")
     
     if cell_id_filter:
         query += " AND cell_id = ?"
         params.append(cell_id_filter)
     
     c.execute(query, tuple(params))
-    rows = c.fetchall()
+    rows = np.array(c.fetchall(), dtype=np.float64).reshape(-1, 3)
     
     # ヒートマップ用のデータ形式 [lat, lon, intensity]
-    heatmap_points = []
-    for r in rows:
-        if r[1] is not None and r[2] is not None:  # lat, lon not null
-            # RSSI値を強度に変換（-20から-120の範囲を0.1から1.0にマッピング）
-            rssi = r[4] if r[4] is not None else -100
-            intensity = max(0.1, min(1.0, (rssi + 120) / 100))
-            heatmap_points.append([r[1], r[2], intensity])
-    
-    return jsonify(heatmap_points)
+    # RSSI値を強度に変換（-20から-120の範囲を0.1から1.0にマッピング）
+    rows[:, 2] = np.clip((rows[:, 2] + 120) / 100, 0.1, 1.0)
+    return _json(rows)
+
+
+# 1 のとき /cell_map の応答に Server-Timing ヘッダ（db / compute / json の所要時間）を付ける
+SERVER_TIMING = os.environ.get('CELLFINDER_SERVER_TIMING') == '1'
+
+# /cell_ids, /cell_map の応答キャッシュ有効期間[s]（期間フィルタが現在時刻依存のため）
+CACHE_TTL_SEC = 10
+
+
+def _cache_key():
+    """応答キャッシュのキー: (最終 rowid, TTL 区切り)。
+    新しいログが入るか TTL が経過すると変わり、古いキャッシュは自動的に使われなくなる。
+    """
+    db = get_db()
+    last_rowid = db.execute("SELECT MAX(rowid) FROM logs").fetchone()[0]
+    return last_rowid, int(time.time() // CACHE_TTL_SEC)
 
 
 @app.route('/cell_ids')
 def get_cell_ids():
     """利用可能なセルIDのリストを返す"""
+    return _json_bytes_response(_cell_ids_json(*_cache_key()))
+
+
+@lru_cache(maxsize=8)
+def _cell_ids_json(last_rowid, ttl_bucket):
     db = get_db()
     c = db.cursor()
     one_hour_ago_ms = int(time.time() * 1000) - 3600 * 1000
     c.execute("SELECT DISTINCT cell_id FROM logs WHERE timestamp > ? AND cell_id IS NOT NULL ORDER BY cell_id", (one_hour_ago_ms,))
     rows = c.fetchall()
     cell_ids = [row[0] for row in rows]
-    return jsonify(cell_ids)
+    return orjson.dumps(cell_ids)
+
+
+# RSSI の有効範囲[dBm]（この範囲にクリップし、整数 dBm として扱う）
+RSSI_MIN_DBM = -140
+RSSI_MAX_DBM = -20
+RSSI_TABLE_DBM = np.arange(RSSI_MIN_DBM, RSSI_MAX_DBM + 1, dtype=np.float64)
 
+# 10^(x/10) = exp(x * ln(10)/10)
+_LN10_OVER_10 = math.log(10.0) / 10.0
 
-def _rssi_to_distance_m(rssi_dbm: float, n: float, ref_rssi_dbm: float, ref_dist_m: float) -> float:
+
+def _rssi_to_distance_m(rssi_dbm, n: float, ref_rssi_dbm: float, ref_dist_m: float):
     """対数距離モデル: PL(d) = PL(d0) + 10 n log10(d/d0)
     ここでは RSSI[dBm] ≈ ref_rssi_dbm - 10 n log10(d/ref_dist_m)
     より d = ref_dist_m * 10^((ref_rssi_dbm - rssi_dbm)/(10 n))
+    rssi_dbm は NumPy 配列でもよい（要素ごとに計算）。
     """
     n = max(n, 0.1)
-    d = ref_dist_m * (10 ** ((ref_rssi_dbm - rssi_dbm) / (10.0 * n)))
+    d = ref_dist_m * np.exp((ref_rssi_dbm - rssi_dbm) * (_LN10_OVER_10 / n))
     # 安全な範囲にクリップ（1 m〜50 km）
-    return max(1.0, min(d, 50_000.0))
+    return np.clip(d, 1.0, 50_000.0)
+
 
+EARTH_RADIUS_M = 6371000.0
+# 1度あたりの南北方向距離[m]
+M_PER_DEG = EARTH_RADIUS_M * math.pi / 180.0
 
-def _ll_to_xy_m(lat: float, lon: float, lat0: float, lon0: float):
-    R = 6371000.0
-    rad = math.pi / 180.0
-    x = R * math.cos(lat0 * rad) * (lon - lon0) * rad
-    y = R * (lat - lat0) * rad
+
+def _ll_to_xy_m(lat, lon, lat0: float, lon0: float, cos_lat0: float):
+    """緯度経度 → (lat0, lon0) 中心の局所平面座標[m]（正距円筒近似）。
+    lat, lon はスカラーでも NumPy 配列でもよい。cos_lat0 = cos(lat0) は呼び出し側で
+    基準点ごとに1回だけ計算し、_xy_to_ll と共有する。
+    """
+    x = (lon - lon0) * (M_PER_DEG * cos_lat0)
+    y = (lat - lat0) * M_PER_DEG
     return x, y
 
 
-def _xy_to_ll(x: float, y: float, lat0: float, lon0: float):
-    R = 6371000.0
-    deg = 180.0 / math.pi
-    lat = y / R * deg + lat0
-    lon = x / (R * math.cos(lat0 * math.pi / 180.0)) * deg + lon0
+def _xy_to_ll(x, y, lat0: float, lon0: float, cos_lat0: float):
+    lat = y / M_PER_DEG + lat0
+    lon = x / (M_PER_DEG * cos_lat0) + lon0
     return lat, lon
 
 
-def _circle_intersections(x0, y0, r0, x1, y1, r1):
-    """2円の交点（最大2点）を返す。交わらなければ空。
-    戻り値: [(x, y, w_angle), ...] ここで w_angle は交差角に基づく重み（0..1）。
+def _pairwise_intersections(xs, ys, rs):
+    """全ペア (i < j) の2円の交点を一括で返す。交わらないペアは含まない。
+    戻り値: (k, 3) 配列 [x, y, w_angle]。w_angle は交差角に基づく重み（0..1）。
+    各ペアの交点はループ版と同じ順序（p1, p2）で並ぶ。
     """
-    dx = x1 - x0
-    dy = y1 - y0
-    d = math.hypot(dx, dy)
-    # 分離 or 包含しすぎ or ほぼ同心
-    if d <= 1e-6 or d > r0 + r1 or d < abs(r0 - r1):
-        return []
-    # 交点
-    a = (r0*r0 - r1*r1 + d*d) / (2*d)
-    h2 = r0*r0 - a*a
-    if h2 < 0:
-        # 丸め誤差
-        h2 = 0.0
-    h = math.sqrt(h2)
+    i, j = np.triu_indices(len(xs), k=1)
+    x0, y0, r0 = xs[i], ys[i], rs[i]
+    dx = xs[j] - x0
+    dy = ys[j] - y0
+    r1 = rs[j]
+    d2 = dx * dx + dy * dy
+    rsum = r0 + r1
+    rdif = r0 - r1
+    # 分離 or 包含しすぎ or ほぼ同心 のペアを除外（距離の2乗のまま比較し、sqrt は残ったペアのみ）
+    ok = (d2 > 1e-12) & (d2 <= rsum * rsum) & (d2 >= rdif * rdif)
+    x0, y0, r0, r1, dx, dy = x0[ok], y0[ok], r0[ok], r1[ok], dx[ok], dy[ok]
+    d = np.sqrt(d2[ok])
+
+    # 交点（丸め誤差で h2 < 0 になる分は 0 に丸める）
+    a = (r0 * r0 - r1 * r1 + d * d) / (2 * d)
+    h = np.sqrt(np.maximum(r0 * r0 - a * a, 0.0))
     xm = x0 + a * dx / d
     ym = y0 + a * dy / d
     rx = -dy * (h / d)
     ry = dx * (h / d)
-    p1 = (xm + rx, ym + ry)
-    p2 = (xm - rx, ym - ry)
 
     # 交差角重み：浅い交差ほど小さく、深い交差ほど大きい
-    denom = max(1e-6, min(r0, r1))
-    w_angle = max(0.0, min(1.0, h / denom))
+    w_angle = np.clip(h / np.maximum(np.minimum(r0, r1), 1e-6), 0.0, 1.0)
 
-    # 接する場合は1点
-    if h <= 1e-6:
-        return [(p1[0], p1[1], w_angle)]
-    return [(p1[0], p1[1], w_angle), (p2[0], p2[1], w_angle)]
+    # (ペア, p1/p2, xyw) に並べ、接する場合 (h <= 1e-6) は p2 を落とす
+    both = np.stack([np.column_stack([xm + rx, ym + ry, w_angle]),
+                     np.column_stack([xm - rx, ym - ry, w_angle])], axis=1)
+    keep = np.column_stack([np.ones(len(h), dtype=bool), h > 1e-6])
+    return both[keep]
+
+
+# 近傍ペアを一度に列挙する上限（(i, j, 距離) 1組 24 B、約 6 MB。小さめの方がキャッシュに載って速い）
+DENSITY_BLOCK_PAIRS = 250_000
+
+
+def _density_scores(tree, pts, w, bw):
+    """各点について半径 bw 以内にある点の重み和（近傍密度、自分自身を含む）を返す。
+    まず各点の近傍数だけを数え（ペアは作らない）、その累積和で問い合わせ点を区切って、
+    1ブロックの近傍ペア数が DENSITY_BLOCK_PAIRS 以下になるようにして列挙・集計する。
+    疎なデータは1回で済み、密なクラスタでもメモリ使用量は一定に抑えられる。
+    """
+    n = len(pts)
+    cum = np.cumsum(tree.query_ball_point(pts, bw, return_length=True))
+    scores = np.empty(n)
+    s = 0
+    while s < n:
+        done = cum[s - 1] if s > 0 else 0
+        # 近傍数が上限を超える点が単独で来た場合も1行は進める
+        e = max(s + 1, int(np.searchsorted(cum, done + DENSITY_BLOCK_PAIRS, side='right')))
+        pairs = cKDTree(pts[s:e]).sparse_distance_matrix(tree, bw, output_type='ndarray')
+        scores[s:e] = np.bincount(pairs['i'], weights=w[pairs['j']], minlength=e - s)
+        s = e
+    return scores
 
 
 @app.route('/cell_map')
@@ -205,12 +316,11 @@ def cell_map():
       - bandwidth_m: 交点クラスタリング半径[m]（既定 150）
       - method: 'accum'（交点投票。既定） or 'centroid'（従来の加重重心）
       - debug: 1 でデバッグ情報（各観測円）を返す
+               形式: "debug": {"circles": {"lat": [...], "lon": [...], "radius_m": [...]}}
     重複排除:
       - 同一 (cell_id, type, lat, lon) のレコードが複数ある場合は、最新 (timestamp が最大) のみ利用。
+    応答は (クエリ引数, 最終 rowid, TTL 区切り) ごとにキャッシュする。
     """
-    db = get_db()
-    c = db.cursor()
-
     # パラメータ取得
     ple = request.args.get('ple', default=2.0, type=float)
     window_sec = request.args.get('window_sec', default=None, type=int)
@@ -220,97 +330,126 @@ def cell_map():
     method = request.args.get('method', default='accum', type=str)
     debug_flag = request.args.get('debug', default=0, type=int)
 
+    body = _cell_map_json(ple, window_sec, ref_rssi, ref_dist, bandwidth_m, method, debug_flag,
+                          *_cache_key())
+    resp = _json_bytes_response(body)
+    if SERVER_TIMING:
+        # キャッシュから返した場合は計測値がない
+        resp.headers['Server-Timing'] = g.get('server_timing', 'cache;desc="hit"')
+    return resp
+
+
+def _server_timing(**phases_sec):
+    """各フェーズの所要時間[s]を W3C Server-Timing ヘッダの値（ms）に整形する。"""
+    return ", ".join(f"{name};dur={sec * 1000:.1f}" for name, sec in phases_sec.items())
+
+
+# /cell_map の観測1件分（SQL の SELECT 列順）
+OBS_DTYPE = np.dtype([('cell_id', object), ('type', object),
+                      ('lat', np.float64), ('lon', np.float64), ('rssi', np.float64)])
+
+
+@lru_cache(maxsize=64)
+def _cell_map_json(ple, window_sec, ref_rssi, ref_dist, bandwidth_m, method, debug_flag,
+                   last_rowid, ttl_bucket):
+    """cell_map の推定処理本体。結果は orjson でシリアライズした bytes で返す。"""
+    t_start = time.perf_counter()
+    db = get_db()
+    c = db.cursor()
+
     # 期間フィルタ
     params = []
-    query = "SELECT cell_id, type, lat, lon, rssi, timestamp FROM logs WHERE cell_id IS NOT NULL"
+    where = "cell_id IS NOT NULL AND lat IS NOT NULL AND lon IS NOT NULL"
     if window_sec is not None and window_sec > 0:
         cutoff_ms = int(time.time() * 1000) - window_sec * 1000
-        query += " AND timestamp > ?"
+        where += " AND timestamp > ?"
         params.append(cutoff_ms)
 
+    # 完全一致重複（位置情報+セル情報が同一）のうち最新のみを SQL 側で採用し、
+    # その RSSI が数値でない観測は除外
+    # （MAX() 集約の裸の列 rssi は、SQLite では timestamp 最大の行の値になる）
+    query = f"""
+        SELECT cell_id, type, lat, lon, rssi FROM (
+            SELECT cell_id, type, lat, lon, rssi, MAX(timestamp)
+            FROM logs WHERE {where}
+            GROUP BY cell_id, type, lat, lon
+        ) WHERE typeof(rssi) IN ('integer', 'real')"""
     c.execute(query, tuple(params))
-    rows = c.fetchall()
 
-    # 完全一致重複（位置情報+セル情報が同一）のうち最新のみを採用
-    latest_rows = {}
-    for cell_id, ctype, lat, lon, rssi, ts in rows:
-        if lat is None or lon is None:
-            continue
-        key = (cell_id, ctype, lat, lon)
-        prev = latest_rows.get(key)
-        if prev is None or ts > prev[-1]:
-            latest_rows[key] = (cell_id, ctype, lat, lon, rssi, ts)
-
-    # セルIDごとに観測をグループ化
-    by_cell = {}
-    for cell_id, ctype, lat, lon, rssi, _ts in latest_rows.values():
-        try:
-            rssi_dbm = float(rssi)
-        except Exception:
-            continue
-        by_cell.setdefault(cell_id, {"type": ctype, "logs": []})
-        by_cell[cell_id]["logs"].append({"lat": lat, "lon": lon, "rssi": rssi_dbm})
+    # カーソルから直接列配列へ読み込む（行タプルのリストを作らない）
+    obs = np.fromiter(c, dtype=OBS_DTYPE)
+    t_db = time.perf_counter()
+    if len(obs) == 0:
+        if SERVER_TIMING:
+            g.server_timing = _server_timing(db=t_db - t_start)
+        return orjson.dumps([])
+
+    # セルIDごとに観測をグループ化（np.unique + bincount で全セル一括集計）
+    lats = obs['lat']
+    lons = obs['lon']
+    uniq, first_idx, inv, counts = np.unique(
+        obs['cell_id'], return_index=True, return_inverse=True, return_counts=True)
+
+    # RSSI は整数 dBm で [-140, -20] にクリップするので、取りうる 121 値について
+    # 距離と重心重みを一度だけ計算し、各観測は表引きする
+    rssi_idx = (np.rint(np.clip(obs['rssi'], RSSI_MIN_DBM, RSSI_MAX_DBM)) - RSSI_MIN_DBM).astype(np.intp)
+    dist_lut = _rssi_to_distance_m(RSSI_TABLE_DBM, ple, ref_rssi, ref_dist)
+
+    # 従来の重心フォールバック用: 電力重みの重心（全セル分を一括計算）
+    # w = p_mw^(2/n) = 10^(rssi/10 * 2/n) を exp 1回で求める
+    w_c = np.exp(RSSI_TABLE_DBM * (_LN10_OVER_10 * 2.0 / max(ple, 0.1)))[rssi_idx]
+    n_cells = len(uniq)
+    sum_w = np.bincount(inv, weights=w_c, minlength=n_cells)
+    sum_lat = np.bincount(inv, weights=lats * w_c, minlength=n_cells)
+    sum_lon = np.bincount(inv, weights=lons * w_c, minlength=n_cells)
+    has_w = sum_w > 0
+    safe_w = np.where(has_w, sum_w, 1.0)
+    centroids = [(la, lo) if ok else (None, None)
+                 for la, lo, ok in zip((sum_lat / safe_w).tolist(), (sum_lon / safe_w).tolist(), has_w.tolist())]
+
+    # 観測をセル順に一度だけ並べ替え（inv の安定ソート）、各セルを連続区間のビューで扱う
+    order = np.argsort(inv, kind='stable')
+    lats_by_cell = lats[order]
+    lons_by_cell = lons[order]
+    dist_by_cell = dist_lut[rssi_idx[order]]
+    bounds = np.concatenate(([0], np.cumsum(counts))).tolist()
 
     result = []
 
-    for cell_id, info in by_cell.items():
-        logs = info["logs"]
-        ctype = info["type"]
-        if len(logs) == 0:
-            result.append({"cell_id": cell_id, "type": ctype, "lat": None, "lon": None, "count": 0})
-            continue
+    for k, cell_id in enumerate(uniq):
+        cell = slice(bounds[k], bounds[k + 1])
+        ctype = obs['type'][first_idx[k]]
+        count = int(counts[k])
+        c_lats = lats_by_cell[cell]
+        c_lons = lons_by_cell[cell]
+        rs = dist_by_cell[cell]
 
-        # 従来の重心フォールバック用: 電力重みの重心
-        def centroid_estimate():
-            sum_lat = sum_lon = sum_w = 0.0
-            for log in logs:
-                rssi_dbm = max(min(log["rssi"], -20.0), -140.0)
-                p_mw = 10 ** (rssi_dbm / 10.0)
-                w = (p_mw ** (2.0 / max(ple, 0.1)))
-                sum_lat += log["lat"] * w
-                sum_lon += log["lon"] * w
-                sum_w += w
-            if sum_w > 0:
-                return (sum_lat / sum_w, sum_lon / sum_w)
-            return (None, None)
-
-        if method == 'centroid' or len(logs) < 2:
-            est_latlon = centroid_estimate()
-            out = {"cell_id": cell_id, "type": ctype, "lat": est_latlon[0], "lon": est_latlon[1], "count": len(logs)}
+        # 円のデバッグ（RSSI→距離）。列ごとの配列で返し、orjson が NumPy 配列のまま書き出す
+        debug_circles = {"lat": c_lats, "lon": c_lons, "radius_m": rs} if debug_flag else None
+
+        if method == 'centroid' or count < 2:
+            est_latlon = centroids[k]
+            out = {"cell_id": cell_id, "type": ctype, "lat": est_latlon[0], "lon": est_latlon[1], "count": count}
             if debug_flag:
-                # 円のデバッグ（RSSI→距離）
-                out["debug"] = {"circles": [{"lat": l["lat"], "lon": l["lon"], "radius_m": _rssi_to_distance_m(max(min(l["rssi"], -20.0), -140.0), ple, ref_rssi, ref_dist)} for l in logs]}
+                out["debug"] = {"circles": debug_circles}
             result.append(out)
             continue
 
         # 局所平面で処理（メートル座標）
-        lat0 = sum(l["lat"] for l in logs) / len(logs)
-        lon0 = sum(l["lon"] for l in logs) / len(logs)
-
-        pts = []  # (x, y, r)
-        debug_circles = []
-        for log in logs:
-            rssi_dbm = max(min(log["rssi"], -20.0), -140.0)
-            d_m = _rssi_to_distance_m(rssi_dbm, ple, ref_rssi, ref_dist)
-            x, y = _ll_to_xy_m(log["lat"], log["lon"], lat0, lon0)
-            pts.append((x, y, d_m))
-            if debug_flag:
-                debug_circles.append({"lat": log["lat"], "lon": log["lon"], "radius_m": d_m})
+        lat0 = float(c_lats.mean())
+        lon0 = float(c_lons.mean())
+        cos_lat0 = math.cos(math.radians(lat0))
+        xs, ys = _ll_to_xy_m(c_lats, c_lons, lat0, lon0, cos_lat0)
 
         # 全ペアの円交点を収集（交差角重み付き）
-        intersections = []
-        n = len(pts)
-        for i in range(n):
-            x0, y0, r0 = pts[i]
-            for j in range(i + 1, n):
-                x1, y1, r1 = pts[j]
-                inter = _circle_intersections(x0, y0, r0, x1, y1, r1)
-                for (px, py, wang) in inter:
-                    intersections.append((px, py, wang))
-
-        if not intersections:
-            est_latlon = centroid_estimate()
-            out = {"cell_id": cell_id, "type": ctype, "lat": est_latlon[0], "lon": est_latlon[1], "count": len(logs)}
+        # メートル単位の局所平面（半径は最大 50 km）なので float32 で十分な精度があり、
+        # O(n^2) のペア配列のメモリ帯域を半減できる
+        inter = _pairwise_intersections(xs.astype(np.float32), ys.astype(np.float32),
+                                        rs.astype(np.float32))  # (k, 3): x, y, w_angle
+
+        if len(inter) == 0:
+            est_latlon = centroids[k]
+            out = {"cell_id": cell_id, "type": ctype, "lat": est_latlon[0], "lon": est_latlon[1], "count": count}
             if debug_flag:
                 out["debug"] = {"circles": debug_circles}
             result.append(out)
@@ -318,268 +457,71 @@ def cell_map():
 
         # 近傍密度（半径 bandwidth_m 内の票数）最大の点を中心に加重平均
         bw = max(5.0, float(bandwidth_m))
-        best_idx = -1
-        best_score = -1.0
-        for k, (xk, yk, wk) in enumerate(intersections):
-            score = 0.0
-            for (xi, yi, wi) in intersections:
-                if (xi - xk) * (xi - xk) + (yi - yk) * (yi - yk) <= bw * bw:
-                    score += wi
-            if score > best_score:
-                best_score = score
-                best_idx = k
-        cx, cy, _ = intersections[best_idx]
+        pts = inter[:, :2].astype(np.float64)
+        tree = cKDTree(pts)
+        scores = _density_scores(tree, pts, inter[:, 2], bw)
+        best = int(np.argmax(scores))
+        cx, cy, _ = inter[best].tolist()
 
         # ベスト近傍で加重平均（距離減衰×交差角重み）
-        sumx = sumy = sumw = 0.0
-        for (xi, yi, wi) in intersections:
-            d2 = (xi - cx) * (xi - cx) + (yi - cy) * (yi - cy)
-            if d2 <= bw * bw:
-                w_dist = (1.0 - math.sqrt(d2) / bw)  # 0..1
-                w = wi * w_dist
-                sumx += xi * w
-                sumy += yi * w
-                sumw += w
+        near = inter[tree.query_ball_point(pts[best], bw)]
+        d = np.hypot(near[:, 0] - cx, near[:, 1] - cy)
+        w = near[:, 2] * np.maximum(1.0 - d / bw, 0.0)  # 交差角重み × 距離減衰(0..1)
+        sumw = w.sum()
         if sumw > 0:
-            ex = sumx / sumw
-            ey = sumy / sumw
+            ex = float(near[:, 0] @ w / sumw)
+            ey = float(near[:, 1] @ w / sumw)
         else:
             ex, ey = cx, cy
 
-        est_lat, est_lon = _xy_to_ll(ex, ey, lat0, lon0)
+        est_lat, est_lon = _xy_to_ll(ex, ey, lat0, lon0, cos_lat0)
         out = {
             "cell_id": cell_id,
             "type": ctype,
             "lat": est_lat,
             "lon": est_lon,
-            "count": len(logs)
+            "count": count
         }
         if debug_flag:
             out["debug"] = {"circles": debug_circles}
         result.append(out)
 
-    return jsonify(result)
+    t_compute = time.perf_counter()
+    body = orjson.dumps(result, option=orjson.OPT_SERIALIZE_NUMPY)
+    if SERVER_TIMING:
+        g.server_timing = _server_timing(db=t_db - t_start, compute=t_compute - t_db,
+                                         json=time.perf_counter() - t_compute)
+    return body
 
 
 @app.route('/map')
 def map_page():
-    """Leafletで地図を表示するページ"""
-    return """
-<!DOCTYPE html>
-<html>
-<head>
-  <meta charset="utf-8" />
-  <title>Cell Logger Map</title>
-  <style>
-    #map { height: 80vh; width: 100%; background: #f0f0f0; position: relative; }
-    #controls { margin: 10px 0; }
-    .filter-control { margin: 0 10px 10px 0; display: inline-block; }
-    .filter-control label { margin-right: 5px; }
-    .filter-control select, .filter-control input { padding: 5px; }
-    #status { margin: 10px 0; padding: 10px; background: #e8f4f8; border: 1px solid #bee5eb; }
-    .data-point { position: absolute; width: 10px; height: 10px; border-radius: 50%; z-index: 1000; cursor: pointer; }
-    .heatmap-point { opacity: 0.7; }
-    .pin-point { background: blue; }
-    .base-station { background: red; width: 15px; height: 15px; }
-  </style>
-</head>
-<body>
-  <h3>Cell Logger Map - Heatmap View</h3>
-  <div id="controls">
-    <div class="filter-control">
-      <label for="cellIdFilter">Cell ID Filter:</label>
-      <select id="cellIdFilter">
-        <option value="">All Cell IDs</option>
-      </select>
-    </div>
-    <div class="filter-control">
-      <label for="displayMode">Display Mode:</label>
-      <select id="displayMode">
-        <option value="heatmap">Heatmap</option>
-        <option value="pins">Pins (Original)</option>
-      </select>
-    </div>
-    <div class="filter-control">
-      <button onclick="updateMap()">Refresh</button>
-    </div>
-  </div>
-  <div id="status">Loading map data...</div>
-  <div id="map">
-    <div style="position: absolute; top: 50%; left: 50%; transform: translate(-50%, -50%); text-align: center;">
-      <p>Heatmap Visualization</p>
-      <p id="mapInfo">Loading data...</p>
-    </div>
-  </div>
-  
-  <!-- Fallback implementation without external dependencies -->
-  <script>
-    var mapElement = document.getElementById('map');
-    var statusElement = document.getElementById('status');
-    var currentData = [];
-    var currentMode = 'heatmap';
-    
-    function clearMap() {
-      var points = mapElement.querySelectorAll('.data-point');
-      points.forEach(function(p) { p.remove(); });
-    }
-    
-    function getColorFromIntensity(intensity) {
-      // Convert intensity (0-1) to color
-      if (intensity > 0.8) return '#ff0000'; // red
-      if (intensity > 0.6) return '#ff8000'; // orange  
-      if (intensity > 0.4) return '#ffff00'; // yellow
-      if (intensity > 0.2) return '#80ff00'; // yellow-green
-      return '#0080ff'; // blue
-    }
-    
-    function createDataPoint(lat, lon, intensity, info, isBaseStation) {
-      var point = document.createElement('div');
-      point.className = 'data-point ' + (currentMode === 'heatmap' ? 'heatmap-point' : 'pin-point');
-      if (isBaseStation) point.className += ' base-station';
-      
-      // Simple positioning (would need proper map projection in real implementation)
-      var x = ((lon - 135.0) * 10000 + 50) + '%';
-      var y = ((35.0 - lat) * 10000 + 50) + '%';
-      point.style.left = x;
-      point.style.top = y;
-      
-      if (currentMode === 'heatmap' && !isBaseStation) {
-        point.style.background = getColorFromIntensity(intensity);
-        point.style.width = (intensity * 20 + 5) + 'px';
-        point.style.height = (intensity * 20 + 5) + 'px';
-        point.style.opacity = intensity;
-      }
-      
-      point.title = info;
-      point.onclick = function() { alert(info); };
-      mapElement.appendChild(point);
-    }
-
-    function loadCellIds() {
-      fetch('/cell_ids')
-        .then(res => res.json())
-        .then(cellIds => {
-          var select = document.getElementById('cellIdFilter');
-          // Clear existing options except "All"
-          while (select.children.length > 1) {
-            select.removeChild(select.lastChild);
-          }
-          // Add cell ID options
-          cellIds.forEach(cellId => {
-            var option = document.createElement('option');
-            option.value = cellId;
-            option.textContent = cellId;
-            select.appendChild(option);
-          });
-          statusElement.innerHTML = 'Found ' + cellIds.length + ' cell IDs: ' + cellIds.join(', ');
-        })
-        .catch(err => {
-          console.error('Failed to load cell IDs:', err);
-          statusElement.innerHTML = 'Error loading cell IDs: ' + err.message;
-        });
-    }
-
-    function updateMap() {
-      clearMap();
-      currentMode = document.getElementById('displayMode').value;
-      var cellIdFilter = document.getElementById('cellIdFilter').value;
-      
-      statusElement.innerHTML = 'Loading data for mode: ' + currentMode + 
-        (cellIdFilter ? ' (Cell ID: ' + cellIdFilter + ')' : ' (All cells)');
-      
-      if (currentMode === 'heatmap') {
-        updateHeatmap(cellIdFilter);
-      } else {
-        updatePins(cellIdFilter);
-      }
-      
-      // Always show estimated base stations
-      updateBaseStations();
-    }
-    
-    function updateHeatmap(cellIdFilter) {
-      var url = '/heatmap_data';
-      if (cellIdFilter) {
-        url += '?cell_id=' + encodeURIComponent(cellIdFilter);
-      }
-      
-      fetch(url)
-        .then(res => res.json())
-        .then(data => {
-          document.getElementById('mapInfo').innerHTML = 
-            'Heatmap: ' + data.length + ' data points' + 
-            (cellIdFilter ? ' for Cell ID: ' + cellIdFilter : '');
-          
-          data.forEach(function(point) {
-            var lat = point[0];
-            var lon = point[1]; 
-            var intensity = point[2];
-            var info = 'Heatmap Point\\nLat: ' + lat + '\\nLon: ' + lon + '\\nIntensity: ' + intensity.toFixed(2);
-            createDataPoint(lat, lon, intensity, info, false);
-          });
-          
-          statusElement.innerHTML = 'Heatmap loaded: ' + data.length + ' points';
-        })
-        .catch(err => {
-          console.error('Failed to load heatmap data:', err);
-          statusElement.innerHTML = 'Error loading heatmap: ' + err.message;
-        });
-    }
-    
-    function updatePins(cellIdFilter) {
-      var url = '/map_data';
-      if (cellIdFilter) {
-        url += '?cell_id=' + encodeURIComponent(cellIdFilter);
-      }
-      
-      fetch(url)
-        .then(res => res.json())
-        .then(data => {
-          document.getElementById('mapInfo').innerHTML = 
-            'Pins: ' + data.length + ' data points' + 
-            (cellIdFilter ? ' for Cell ID: ' + cellIdFilter : '');
-          
-          data.forEach(function(log) {
-            if (log.lat != null && log.lon != null) {
-              var info = 'Pin\\nType: ' + log.type + '\\nRSSI: ' + log.rssi + '\\nCell ID: ' + log.cell_id;
-              createDataPoint(log.lat, log.lon, 0.5, info, false);
-            }
-          });
-          
-          statusElement.innerHTML = 'Pins loaded: ' + data.length + ' points';
-        })
-        .catch(err => {
-          console.error('Failed to load pin data:', err);
-          statusElement.innerHTML = 'Error loading pins: ' + err.message;
-        });
-    }
-    
-    function updateBaseStations() {
-      fetch('/cell_map?debug=1')
-        .then(res => res.json())
-        .then(cells => {
-          cells.forEach(function(cell) {
-            if (cell.lat != null && cell.lon != null) {
-              var info = 'Base Station\\nCell ID: ' + cell.cell_id + '\\nType: ' + cell.type + '\\nCount: ' + cell.count;
-              createDataPoint(cell.lat, cell.lon, 1.0, info, true);
-            }
-          });
-        })
-        .catch(err => console.error('Failed to load base station data:', err));
-    }
-
-    // Initialize
-    loadCellIds();
-    updateMap();
-    setInterval(function() {
-      loadCellIds();
-      updateMap();
-    }, 30000); // 30秒ごとに更新
-  </script>
-</body>
-</html>
-    """
+    """Leafletで地図を表示するページ（static/map.html。ETag/Last-Modified 付きで返す）"""
+    return app.send_static_file('map.html')
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
+    # Werkzeug の開発サーバではなく gunicorn のスレッドワーカーで起動する。
+    # init_db() は import 時にテーブルを作り直し、書き込みロックと応答キャッシュもプロセス内のため、
+    # ワーカープロセスは1つに固定してスレッドで並列化する（SQLite 接続はスレッドごと）。
+    from gunicorn.app.base import BaseApplication
+
+    class StandaloneApplication(BaseApplication):
+        def __init__(self, application, options):
+            self.application = application
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return self.application
+
+    StandaloneApplication(app, {
+        'bind': '0.0.0.0:5000',
+        'workers': 1,
+        'worker_class': 'gthread',
+        'threads': 8,
+    }).run()